@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+from aiogram import Bot
+
+from app.config import settings
+
+
+# Kept out of app.main so other modules can import it at module level without
+# a circular import
+@lru_cache()
+def get_bot() -> Bot:
+    """Get the shared bot instance, created on first use"""
+    return Bot(token=settings.telegram_token)
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import Optional
 from pydantic_settings import BaseSettings
 
@@ -9,6 +10,10 @@ class Settings(BaseSettings):
     
     # Database
     database_url: str
+    db_pool_size: int = 20
+    db_max_overflow: int = 10
+    db_pool_timeout: int = 30
+    db_behind_pgbouncer: bool = False
     
     # Default settings
     default_tz: str = "Asia/Singapore"
@@ -31,4 +36,17 @@ class Settings(BaseSettings):
         case_sensitive = False
 
 
-settings = Settings()
\ No newline at end of file
+@lru_cache()
+def get_settings() -> Settings:
+    """Load and validate settings on first use"""
+    return Settings()
+
+
+class _LazySettings:
+    """Proxy that defers reading/validating the environment until a field is accessed"""
+    
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
+
+
+settings = _LazySettings()
\ No newline at end of file
@@ -1,22 +1,77 @@
-from sqlalchemy import create_engine
+from functools import lru_cache
+from uuid import uuid4
+
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
-# Create database engine
-engine = create_engine(settings.database_url)
 
-# Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def get_async_database_url(database_url: str) -> str:
+    """Convert a sync database URL to its async driver equivalent"""
+    if database_url.startswith("postgres://"):
+        database_url = "postgresql://" + database_url[len("postgres://"):]
+    if database_url.startswith("postgresql://"):
+        return "postgresql+asyncpg://" + database_url[len("postgresql://"):]
+    if database_url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + database_url[len("sqlite://"):]
+    return database_url
+
+
+def _unique_statement_name() -> str:
+    """Unique asyncpg prepared statement name"""
+    return f"__asyncpg_{uuid4()}__"
+
+
+def get_engine_options(database_url: str) -> dict:
+    """Connection pool options; sized so the cron send fan-out doesn't queue on the pool"""
+    if database_url.startswith("sqlite"):
+        # SQLite uses its own pool implementation without these knobs
+        return {}
+    
+    options = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_pre_ping": True,
+        "echo": False,
+    }
+    if settings.db_behind_pgbouncer and database_url.startswith("postgresql+asyncpg://"):
+        # PgBouncer in transaction mode can hand each transaction a different server
+        # connection, so turn off both asyncpg's and SQLAlchemy's statement caches
+        # and give every prepared statement a unique name so they can't collide
+        options["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": _unique_statement_name,
+        }
+    return options
+
+
+@lru_cache()
+def get_engine() -> AsyncEngine:
+    """Get the async database engine, created on first use"""
+    async_database_url = get_async_database_url(settings.database_url)
+    return create_async_engine(async_database_url, **get_engine_options(async_database_url))
+
+
+@lru_cache()
+def get_sessionmaker() -> async_sessionmaker:
+    """Session factory; keeps objects usable after commit without lazy reloads"""
+    return async_sessionmaker(
+        bind=get_engine(), class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+
+def new_session() -> AsyncSession:
+    """Create a new database session"""
+    return get_sessionmaker()()
+
 
 # Create base class for models
 Base = declarative_base()
 
 
-def get_db():
+async def get_db():
     """Dependency to get database session"""
-    db = SessionLocal()
-    try:
+    async with new_session() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,61 +1,78 @@
+from collections import OrderedDict
+
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.filters import Command
+from aiogram.types import CallbackQuery
 from aiogram.exceptions import TelegramAPIError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import and_
 
-from app.models import User, ProcessedCallback
+from app.db import new_session
 from app.logic import (
     get_next_reading, get_user_stats, record_reading, record_break,
     can_take_break, did_read_today, was_nudged_today, get_reading_streak,
-    get_user_local_date, upsert_user, ensure_user_progress, get_current_pointer,
-    get_reading_by_pointer, get_next_pointer
+    get_user_local_date, get_user_local_now, upsert_user, get_current_pointer,
+    get_reading_by_pointer, get_user_by_telegram_id, load_user_ctx,
+    claim_callback
 )
 from app.messages import (
     get_help_message, get_stats_message, get_break_rejected_message,
     get_break_recorded_message, get_reading_recorded_message,
     get_no_readings_message, get_streak_celebration_message,
-    format_reading_text
+    format_reading_text, get_reading_keyboard, unpack_callback_data
 )
 from app.config import settings
 
+# Recently processed callback query IDs, used to ignore Telegram retries
+MAX_PROCESSED_CALLBACKS = 1000
+_processed_callbacks: OrderedDict[str, None] = OrderedDict()
+
+
+def _seen(callback_id: str) -> bool:
+    """Check if callback was already processed, remembering it if not"""
+    if callback_id in _processed_callbacks:
+        _processed_callbacks.move_to_end(callback_id)
+        return True
+    
+    _processed_callbacks[callback_id] = None
+    while len(_processed_callbacks) > MAX_PROCESSED_CALLBACKS:
+        _processed_callbacks.popitem(last=False)
+    return False
+
+
+def _forget(callback_id: str) -> None:
+    """Drop a callback from the processed set so a redelivery is handled again"""
+    _processed_callbacks.pop(callback_id, None)
+
 
-async def start_command(message: types.Message, db: Session):
+async def start_command(message: types.Message, db: AsyncSession):
     """Handle /start command"""
     user_id = message.from_user.id
     
     # Upsert user
-    user = upsert_user(
+    user = await upsert_user(
         db, user_id, 
         message.from_user.username,
         message.from_user.first_name,
         message.from_user.last_name
     )
     
-    # Ensure user has progress record
-    ensure_user_progress(db, user)
+    await db.commit()
     
     # Get current pointer and reading
-    current_month, current_day = get_current_pointer(db, user)
-    reading = get_reading_by_pointer(db, current_month, current_day)
+    current_month, current_day = get_current_pointer(user)
+    reading = await get_reading_by_pointer(db, current_month, current_day)
     
     if not reading:
         await message.answer("Welcome! No readings available at the moment.")
         return
     
     # Get stats and format message
-    stats = get_user_stats(db, user)
+    now = get_user_local_now(user.timezone)
+    stats = await get_user_stats(db, user, now)
     text = format_reading_text(reading, stats)
     
-    # Create keyboard
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton("✅ Read", callback_data=f"read|{reading['month']}|{reading['day']}"),
-            InlineKeyboardButton("🛌 Break", callback_data=f"break|{reading['month']}|{reading['day']}")
-        ],
-        [InlineKeyboardButton("📖 Next", callback_data="next")]
-    ])
-    
+    keyboard = get_reading_keyboard(reading['month'], reading['day'])
     await message.answer(text, parse_mode='MarkdownV2', reply_markup=keyboard)
 
 
@@ -64,7 +81,7 @@ async def help_command(message: types.Message):
     await message.answer(get_help_message(), parse_mode='MarkdownV2')
 
 
-async def settz_command(message: types.Message, db: Session):
+async def settz_command(message: types.Message, db: AsyncSession):
     """Handle /settz command"""
     try:
         # Extract timezone from command
@@ -75,10 +92,10 @@ async def settz_command(message: types.Message, db: Session):
         ZoneInfo(timezone)  # This will raise if invalid
         
         # Update user timezone
-        user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+        user = await get_user_by_telegram_id(db, message.from_user.id)
         if user:
             user.timezone = timezone
-            db.commit()
+            await db.commit()
             await message.answer(f"✅ Timezone updated to {timezone}")
         else:
             await message.answer("❌ User not found. Please use /start first.")
@@ -89,115 +106,97 @@ async def settz_command(message: types.Message, db: Session):
         await message.answer(f"❌ Invalid timezone. Error: {str(e)}")
 
 
-async def today_command(message: types.Message, db: Session):
+async def today_command(message: types.Message, db: AsyncSession):
     """Handle /today command"""
-    user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+    user = await load_user_ctx(db, message.from_user.id)
     if not user:
         await message.answer("❌ User not found. Please use /start first.")
         return
     
     # Get current pointer and reading
-    current_month, current_day = get_current_pointer(db, user)
-    reading = get_reading_by_pointer(db, current_month, current_day)
+    current_month, current_day = get_current_pointer(user)
+    reading = await get_reading_by_pointer(db, current_month, current_day)
     
     if not reading:
         await message.answer(get_no_readings_message(), parse_mode='MarkdownV2')
         return
     
     # Get stats and format message
-    stats = get_user_stats(db, user)
+    now = get_user_local_now(user.timezone)
+    stats = await get_user_stats(db, user, now)
     text = format_reading_text(reading, stats)
     
-    # Create keyboard
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton("✅ Read", callback_data=f"read|{reading['month']}|{reading['day']}"),
-            InlineKeyboardButton("🛌 Break", callback_data=f"break|{reading['month']}|{reading['day']}")
-        ],
-        [InlineKeyboardButton("📖 Next", callback_data="next")]
-    ])
-    
+    keyboard = get_reading_keyboard(reading['month'], reading['day'])
     await message.answer(text, parse_mode='MarkdownV2', reply_markup=keyboard)
 
 
-async def next_command(message: types.Message, db: Session):
+async def next_command(message: types.Message, db: AsyncSession):
     """Handle /next command"""
-    user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+    user = await load_user_ctx(db, message.from_user.id)
     if not user:
         await message.answer("❌ User not found. Please use /start first.")
         return
     
     # Get next reading
-    reading = get_next_reading(db, user)
+    reading = await get_next_reading(db, user)
     if not reading:
         await message.answer(get_no_readings_message(), parse_mode='MarkdownV2')
         return
     
     # Get stats and format message
-    stats = get_user_stats(db, user)
+    now = get_user_local_now(user.timezone)
+    stats = await get_user_stats(db, user, now)
     text = format_reading_text(reading, stats)
     
-    # Create keyboard
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton("✅ Read", callback_data=f"read|{reading['month']}|{reading['day']}"),
-            InlineKeyboardButton("🛌 Break", callback_data=f"break|{reading['month']}|{reading['day']}")
-        ],
-        [InlineKeyboardButton("📖 Next", callback_data="next")]
-    ])
-    
+    keyboard = get_reading_keyboard(reading['month'], reading['day'])
     await message.answer(text, parse_mode='MarkdownV2', reply_markup=keyboard)
 
 
-async def stats_command(message: types.Message, db: Session):
+async def stats_command(message: types.Message, db: AsyncSession):
     """Handle /stats command"""
-    user = db.query(User).filter(User.telegram_id == message.from_user.id).first()
+    user = await load_user_ctx(db, message.from_user.id)
     if not user:
         await message.answer("❌ User not found. Please use /start first.")
         return
     
-    stats = get_user_stats(db, user)
+    stats = await get_user_stats(db, user, get_user_local_now(user.timezone))
     text = get_stats_message(stats)
     
     await message.answer(text, parse_mode='MarkdownV2')
 
 
-async def handle_callback_query(callback_query: CallbackQuery, db: Session, bot: Bot):
+async def handle_callback_query(callback_query: CallbackQuery, db: AsyncSession, bot: Bot):
     """Handle callback queries from inline keyboards"""
-    # Check if callback was already processed
-    existing_callback = db.query(ProcessedCallback).filter(
-        ProcessedCallback.callback_id == callback_query.id
-    ).first()
-    
-    if existing_callback:
+    # Check if callback was already processed by this worker
+    if _seen(callback_query.id):
         await callback_query.answer("Already processed.")
         return
     
-    # Mark callback as processed
-    processed = ProcessedCallback(callback_id=callback_query.id)
-    db.add(processed)
-    db.commit()
-    
-    user = db.query(User).filter(User.telegram_id == callback_query.from_user.id).first()
-    if not user:
-        await callback_query.answer("❌ User not found.")
-        return
-    
-    data = callback_query.data
-    parts = data.split('|')
-    action = parts[0]
-    
     try:
+        user = await get_user_by_telegram_id(db, callback_query.from_user.id)
+        if not user:
+            await callback_query.answer("❌ User not found.")
+            return
+        
+        # Snapshot the time once so every check in this callback agrees on "today"
+        now = get_user_local_now(user.timezone)
+        
+        action, pointer = unpack_callback_data(callback_query.data)
+        if action is None:
+            # Not one of our buttons, just acknowledge it
+            await callback_query.answer()
+            return
+        
         if action == "read":
-            plan_month = int(parts[1])
-            plan_day = int(parts[2])
+            plan_month, plan_day = pointer
             
-            # Record reading
-            record_reading(db, user, plan_month, plan_day)
+            # Guard against retries handled by another worker
+            if not await claim_callback(db, callback_query.id):
+                await callback_query.answer("Already processed.")
+                return
             
-            # Get updated stats
-            stats = get_user_stats(db, user)
-            streak = stats['streak']
+            # Record reading (returns updated streak, no need to re-read stats)
+            streak = await record_reading(db, user, plan_month, plan_day, now)
             
             # Send celebration message
             celebration = get_streak_celebration_message(streak)
@@ -206,45 +205,43 @@ async def handle_callback_query(callback_query: CallbackQuery, db: Session, bot:
             await callback_query.answer("✅ Reading recorded!")
             
         elif action == "break":
-            plan_month = int(parts[1])
-            plan_day = int(parts[2])
+            plan_month, plan_day = pointer
             
             # Check if user can take a break
-            if not can_take_break(db, user):
+            if not await can_take_break(db, user, now):
                 await callback_query.answer(get_break_rejected_message(), show_alert=True)
                 return
             
+            # Guard against retries handled by another worker
+            if not await claim_callback(db, callback_query.id):
+                await callback_query.answer("Already processed.")
+                return
+            
             # Record break
-            record_break(db, user, plan_month, plan_day)
+            await record_break(db, user, plan_month, plan_day)
             
             await callback_query.answer("🛌 Break recorded!")
             await callback_query.message.answer(get_break_recorded_message(), parse_mode='MarkdownV2')
             
         elif action == "next":
             # Send next reading (without modifying stored progress)
-            current_month, current_day = get_current_pointer(db, user)
-            next_month, next_day = get_next_pointer(current_month, current_day)
-            reading = get_reading_by_pointer(db, next_month, next_day)
+            reading = await get_next_reading(db, user)
             
             if not reading:
                 await callback_query.answer("No more readings available.")
                 return
             
-            stats = get_user_stats(db, user)
+            stats = await get_user_stats(db, user, now)
             text = format_reading_text(reading, stats)
             
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton("✅ Read", callback_data=f"read|{reading['month']}|{reading['day']}"),
-                    InlineKeyboardButton("🛌 Break", callback_data=f"break|{reading['month']}|{reading['day']}")
-                ],
-                [InlineKeyboardButton("📖 Next", callback_data="next")]
-            ])
-            
+            keyboard = get_reading_keyboard(reading['month'], reading['day'])
             await callback_query.message.answer(text, parse_mode='MarkdownV2', reply_markup=keyboard)
             await callback_query.answer("📖 Next reading sent!")
             
     except Exception as e:
+        # Nothing was committed if the work failed, so a redelivery must not be
+        # ignored here; the DB claim still stops it if the commit did happen
+        _forget(callback_query.id)
         await callback_query.answer(f"❌ Error: {str(e)}", show_alert=True)
 
 
@@ -253,63 +250,40 @@ def register_handlers(dp: Dispatcher):
     
     # Wrapper functions that handle database sessions
     async def start_wrapper(message: types.Message):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
+        async with new_session() as db:
             await start_command(message, db)
-        finally:
-            db.close()
     
     async def help_wrapper(message: types.Message):
+        # /help needs no database access, so no session is opened
         await help_command(message)
     
     async def settz_wrapper(message: types.Message):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
+        async with new_session() as db:
             await settz_command(message, db)
-        finally:
-            db.close()
     
     async def today_wrapper(message: types.Message):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
+        async with new_session() as db:
             await today_command(message, db)
-        finally:
-            db.close()
     
     async def next_wrapper(message: types.Message):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
+        async with new_session() as db:
             await next_command(message, db)
-        finally:
-            db.close()
     
     async def stats_wrapper(message: types.Message):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
+        async with new_session() as db:
             await stats_command(message, db)
-        finally:
-            db.close()
     
-    async def callback_wrapper(callback_query: types.CallbackQuery):
-        from app.db import SessionLocal
-        db = SessionLocal()
-        try:
-            await handle_callback_query(callback_query, db, dp.bot)
-        finally:
-            db.close()
+    async def callback_wrapper(callback_query: types.CallbackQuery, bot: Bot):
+        async with new_session() as db:
+            await handle_callback_query(callback_query, db, bot)
     
     # Register message handlers
-    dp.message.register(start_wrapper, types.Message, commands=['start'])
-    dp.message.register(help_wrapper, types.Message, commands=['help'])
-    dp.message.register(settz_wrapper, types.Message, commands=['settz'])
-    dp.message.register(today_wrapper, types.Message, commands=['today'])
-    dp.message.register(next_wrapper, types.Message, commands=['next'])
-    dp.message.register(stats_wrapper, types.Message, commands=['stats'])
+    dp.message.register(start_wrapper, Command('start'))
+    dp.message.register(help_wrapper, Command('help'))
+    dp.message.register(settz_wrapper, Command('settz'))
+    dp.message.register(today_wrapper, Command('today'))
+    dp.message.register(next_wrapper, Command('next'))
+    dp.message.register(stats_wrapper, Command('stats'))
     
     # Register callback query handler
-    dp.callback_query.register(callback_wrapper, types.CallbackQuery)
\ No newline at end of file
+    dp.callback_query.register(callback_wrapper)
\ No newline at end of file
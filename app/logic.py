@@ -1,45 +1,77 @@
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
+from collections import namedtuple
+from functools import lru_cache
 from typing import Optional, Dict, Any, List
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, desc, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import (
+    and_, bindparam, distinct, func, insert, lambda_stmt, or_, select, text, update
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from zoneinfo import ZoneInfo
 
-from app.models import User, Plan, UserProgress, UserEvent
+from app.models import User, Plan, UserProgress, UserEvent, ProcessedCallback
 from app.config import settings
 
+# How far back to look for read events when calculating a streak
+STREAK_WINDOW_DAYS = 90
 
-def get_user_timezone(user: User) -> ZoneInfo:
+# The plan is small and immutable, so readings are kept in memory by (month, day)
+PLAN_CACHE: Dict[tuple[int, int], Dict[str, Any]] = {}
+
+# Whether PLAN_CACHE holds the whole plan, not just readings cached on demand
+_plan_cache_loaded = False
+
+# Break count (since :cutoff) and completed count for a user, built once and reused
+_USER_COUNTS_SQL = text(
+    "SELECT "
+    "(SELECT COUNT(*) FROM user_events WHERE user_id = :u "
+    "AND action = 'break' AND created_at >= :cutoff), "
+    "(SELECT COUNT(*) FROM user_progress WHERE user_id = :u)"
+)
+
+# Local send times as minutes past midnight (07:00 daily card, 20:00 nudge)
+DAILY_CARD_MINUTES = 7 * 60
+NUDGE_MINUTES = 20 * 60
+
+# Lightweight read-only view of a user, for paths that don't modify the User row
+UserCtx = namedtuple("UserCtx", "id timezone current_month current_day")
+
+
+@lru_cache(maxsize=256)
+def _tz(name: str) -> ZoneInfo:
+    """Get ZoneInfo object for a timezone name (cached)"""
+    return ZoneInfo(name)
+
+
+def get_user_timezone(tz_name: str) -> ZoneInfo:
     """Get user's timezone as ZoneInfo object"""
-    return ZoneInfo(user.timezone)
+    return _tz(tz_name)
 
 
-def get_user_local_now(user: User) -> datetime:
-    """Get current time in user's timezone"""
-    tz = get_user_timezone(user)
+def get_user_local_now(tz_name: str, now: Optional[datetime] = None) -> datetime:
+    """Get current time in user's timezone, reusing `now` if given"""
+    tz = get_user_timezone(tz_name)
+    if now is not None:
+        return now.astimezone(tz)
     return datetime.now(tz)
 
 
-def get_user_local_date(user: User) -> date:
+def get_user_local_date(tz_name: str, now: Optional[datetime] = None) -> date:
     """Get current date in user's timezone"""
-    return get_user_local_now(user).date()
+    return get_user_local_now(tz_name, now).date()
 
 
-def get_current_pointer(db: Session, user: User) -> tuple[int, int]:
-    """Get current pointer (month, day) for user"""
-    # Check if user has any progress
-    last_progress = db.query(UserProgress).filter(
-        UserProgress.user_id == user.id
-    ).order_by(desc(UserProgress.completed_at)).first()
-    
-    if not last_progress:
-        # No progress yet, start from configured start point
-        return settings.start_at_month, settings.start_at_day
-    else:
-        # Return the last completed reading position
-        return last_progress.month, last_progress.day
+def get_current_pointer(user: User) -> tuple[int, int]:
+    """Get the pointer (month, day) of the user's next pending reading"""
+    # record_reading advances the pointer on the user row past the completed reading
+    return (
+        user.current_month or settings.start_at_month,
+        user.current_day or settings.start_at_day
+    )
 
 
-def get_next_pointer(month: int, day: int) -> tuple[int, int]:
+def _compute_next_pointer(month: int, day: int) -> tuple[int, int]:
     """Calculate next pointer from current position"""
     next_month = month
     next_day = day + 1
@@ -54,19 +86,27 @@ def get_next_pointer(month: int, day: int) -> tuple[int, int]:
     return next_month, next_day
 
 
-def get_reading_by_pointer(db: Session, month: int, day: int) -> Optional[Dict[str, Any]]:
-    """Get reading for specific month/day pointer"""
-    # Query plan table with quoted column names
-    plan = db.query(Plan).filter(
-        and_(
-            Plan.Month == month,
-            Plan.Day == day
-        )
-    ).first()
-    
-    if not plan:
-        return None
-    
+@lru_cache(maxsize=1)
+def _get_next_pointer_table() -> Dict[tuple[int, int], tuple[int, int]]:
+    """Precomputed next pointer for every (month, day) in the plan"""
+    return {
+        (month, day): _compute_next_pointer(month, day)
+        for month in range(1, settings.plan_months + 1)
+        for day in range(1, settings.plan_days_per_month + 1)
+    }
+
+
+def get_next_pointer(month: int, day: int) -> tuple[int, int]:
+    """Get next pointer from current position"""
+    next_pointer = _get_next_pointer_table().get((month, day))
+    if next_pointer is None:
+        # Outside the plan grid, fall back to calculating it
+        return _compute_next_pointer(month, day)
+    return next_pointer
+
+
+def _plan_to_reading(plan: Plan) -> Dict[str, Any]:
+    """Convert a Plan row into a reading dict"""
     return {
         'month': plan.Month,
         'day': plan.Day,
@@ -81,33 +121,84 @@ def get_reading_by_pointer(db: Session, month: int, day: int) -> Optional[Dict[s
     }
 
 
-def get_next_reading(db: Session, user: User) -> Optional[Dict[str, Any]]:
-    """Get the next pending reading for a user"""
-    current_month, current_day = get_current_pointer(db, user)
-    next_month, next_day = get_next_pointer(current_month, current_day)
-    return get_reading_by_pointer(db, next_month, next_day)
+async def load_plan_cache(db: AsyncSession) -> int:
+    """Load the whole plan table into PLAN_CACHE, returns number of readings"""
+    global _plan_cache_loaded
+    
+    PLAN_CACHE.clear()
+    result = await db.execute(select(Plan))
+    for plan in result.scalars():
+        PLAN_CACHE[(plan.Month, plan.Day)] = _plan_to_reading(plan)
+    
+    # An empty table may be seeded later, so only a non-empty load counts as complete
+    _plan_cache_loaded = bool(PLAN_CACHE)
+    return len(PLAN_CACHE)
+
 
+async def get_plan(db: AsyncSession) -> Dict[tuple[int, int], Dict[str, Any]]:
+    """Get all readings keyed by (month, day), loading the full plan if not done yet"""
+    # PLAN_CACHE may hold only the few readings get_reading_by_pointer filled in
+    if not _plan_cache_loaded:
+        await load_plan_cache(db)
+    return PLAN_CACHE
 
-def get_reading_streak(db: Session, user: User) -> int:
-    """Calculate user's reading streak ending today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
+
+async def get_reading_by_pointer(db: AsyncSession, month: int, day: int) -> Optional[Dict[str, Any]]:
+    """Get reading for specific month/day pointer"""
+    reading = PLAN_CACHE.get((month, day))
+    if reading is not None:
+        return reading
     
-    # Get all read events in chronological order
-    read_events = db.query(UserEvent).filter(
+    # Not cached (e.g. plan seeded after startup), fall back to the database
+    stmt = lambda_stmt(lambda: select(Plan).where(
         and_(
-            UserEvent.user_id == user.id,
-            UserEvent.action == 'read'
+            Plan.Month == bindparam('m'),
+            Plan.Day == bindparam('d')
         )
-    ).order_by(UserEvent.created_at.desc()).all()
+    ))
+    result = await db.execute(stmt, {'m': month, 'd': day})
+    plan = result.scalars().first()
     
-    # Group by date in user's timezone
-    read_dates = set()
-    for event in read_events:
-        event_date = event.created_at.astimezone(tz).date()
-        read_dates.add(event_date)
+    if not plan:
+        return None
     
-    # Count consecutive days ending today
+    reading = _plan_to_reading(plan)
+    PLAN_CACHE[(month, day)] = reading
+    return reading
+
+
+async def get_next_reading(db: AsyncSession, user: User) -> Optional[Dict[str, Any]]:
+    """Get the next pending reading for a user"""
+    # The stored pointer already is the pending reading, don't advance it again
+    current_month, current_day = get_current_pointer(user)
+    return await get_reading_by_pointer(db, current_month, current_day)
+
+
+async def _get_read_dates(db: AsyncSession, user: User, tz: ZoneInfo, since: datetime) -> set:
+    """Get distinct local dates on which the user read since the given time"""
+    if db.bind.dialect.name == 'postgresql':
+        # Let Postgres convert to local dates so only distinct dates come back
+        stmt = lambda_stmt(lambda: select(
+            distinct(func.date(UserEvent.created_at.op('AT TIME ZONE')(bindparam('tz'))))
+        ).where(
+            UserEvent.user_id == bindparam('u'),
+            UserEvent.action == 'read',
+            UserEvent.created_at >= bindparam('since')
+        ))
+        rows = await db.execute(stmt, {'tz': user.timezone, 'u': user.id, 'since': since})
+        return set(rows.scalars())
+    
+    stmt = lambda_stmt(lambda: select(UserEvent.created_at).where(
+        UserEvent.user_id == bindparam('u'),
+        UserEvent.action == 'read',
+        UserEvent.created_at >= bindparam('since')
+    ))
+    created = await db.execute(stmt, {'u': user.id, 'since': since})
+    return {created_at.astimezone(tz).date() for created_at in created.scalars()}
+
+
+def _count_streak(read_dates: set, today: date) -> int:
+    """Count consecutive read days ending today"""
     streak = 0
     current_date = today
     
@@ -118,39 +209,62 @@ def get_reading_streak(db: Session, user: User) -> int:
     return streak
 
 
-def get_breaks_used(db: Session, user: User) -> int:
+async def get_reading_streak(db: AsyncSession, user: User, now: Optional[datetime] = None,
+                             read_today: bool = False) -> int:
+    """Calculate user's reading streak ending today (`read_today` counts today as read)"""
+    tz = get_user_timezone(user.timezone)
+    now = get_user_local_now(user.timezone, now)
+    today = now.date()
+    window_days = STREAK_WINDOW_DAYS
+    
+    while True:
+        # Only look at read events inside the recent window
+        read_dates = await _get_read_dates(db, user, tz, now - timedelta(days=window_days))
+        if read_today:
+            read_dates.add(today)
+        
+        streak = _count_streak(read_dates, today)
+        if streak < window_days:
+            return streak
+        
+        # Streak spans the whole window, widen it and count again
+        window_days *= 2
+
+
+async def get_breaks_used(db: AsyncSession, user: User, now: Optional[datetime] = None) -> int:
     """Count breaks used in the last 30 days"""
-    tz = get_user_timezone(user)
-    now = datetime.now(tz)
+    now = get_user_local_now(user.timezone, now)
     thirty_days_ago = now - timedelta(days=30)
     
     # Count break events in the last 30 days
-    break_count = db.query(UserEvent).filter(
+    stmt = lambda_stmt(lambda: select(func.count(UserEvent.id)).where(
         and_(
-            UserEvent.user_id == user.id,
+            UserEvent.user_id == bindparam('u'),
             UserEvent.action == 'break',
-            UserEvent.created_at >= thirty_days_ago
+            UserEvent.created_at >= bindparam('since')
         )
-    ).count()
+    ))
+    break_count = await db.scalar(stmt, {'u': user.id, 'since': thirty_days_ago})
     
     return min(break_count, settings.max_breaks_per_30_days)
 
 
-def get_breaks_left(db: Session, user: User) -> int:
+async def get_breaks_left(db: AsyncSession, user: User, now: Optional[datetime] = None) -> int:
     """Get remaining breaks for user"""
-    breaks_used = get_breaks_used(db, user)
+    breaks_used = await get_breaks_used(db, user, now)
     return max(0, settings.max_breaks_per_30_days - breaks_used)
 
 
-def can_take_break(db: Session, user: User) -> bool:
+async def can_take_break(db: AsyncSession, user: User, now: Optional[datetime] = None) -> bool:
     """Check if user can take a break"""
-    return get_breaks_left(db, user) > 0
+    return await get_breaks_left(db, user, now) > 0
 
 
-def record_reading(db: Session, user: User, plan_month: int, plan_day: int) -> None:
-    """Record a reading completion and advance progress"""
-    tz = get_user_timezone(user)
-    now = datetime.now(tz)
+async def record_reading(db: AsyncSession, user: User, plan_month: int, plan_day: int,
+                         now: Optional[datetime] = None) -> int:
+    """Record a reading completion and advance progress, returns the new streak"""
+    # Today is known to be read, so the streak can be worked out before writing
+    streak = await get_reading_streak(db, user, now, read_today=True)
     
     # Add to user_progress
     progress = UserProgress(
@@ -176,10 +290,11 @@ def record_reading(db: Session, user: User, plan_month: int, plan_day: int) -> N
     user.current_month = next_month
     user.current_day = next_day
     
-    db.commit()
+    await db.commit()
+    return streak
 
 
-def record_break(db: Session, user: User, plan_month: int, plan_day: int) -> None:
+async def record_break(db: AsyncSession, user: User, plan_month: int, plan_day: int) -> None:
     """Record a break (doesn't advance progress)"""
     event = UserEvent(
         user_id=user.id,
@@ -188,89 +303,135 @@ def record_break(db: Session, user: User, plan_month: int, plan_day: int) -> Non
         plan_day=plan_day
     )
     db.add(event)
-    db.commit()
+    await db.commit()
 
 
-def record_nudge(db: Session, user: User) -> None:
-    """Record that a nudge was sent"""
-    event = UserEvent(
-        user_id=user.id,
-        action='nudge'
+async def record_nudges(db: AsyncSession, user_ids: List[int]) -> None:
+    """Record nudges for many users in one INSERT (caller commits)"""
+    if not user_ids:
+        return
+    
+    await db.execute(
+        insert(UserEvent), [{'user_id': user_id, 'action': 'nudge'} for user_id in user_ids]
     )
-    db.add(event)
-    db.commit()
 
 
-def was_nudged_today(db: Session, user: User) -> bool:
-    """Check if user was nudged today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
+def _get_local_day_bounds(local_now: datetime) -> tuple[datetime, datetime]:
+    """Get [start, end) of the local day containing `local_now`, as UTC datetimes"""
+    local_midnight = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_utc = local_midnight.astimezone(timezone.utc)
+    # Next local midnight, not start + 24h, since DST change days are 23 or 25 hours long
+    end_utc = (local_midnight + timedelta(days=1)).astimezone(timezone.utc)
+    return start_utc, end_utc
+
+
+async def _has_event_today(db: AsyncSession, user: User, action: str,
+                           now: Optional[datetime] = None) -> bool:
+    """Check if user has an event of the given action today (index-friendly range)"""
+    start_utc, end_utc = _get_local_day_bounds(get_user_local_now(user.timezone, now))
     
-    nudge_today = db.query(UserEvent).filter(
+    stmt = lambda_stmt(lambda: select(UserEvent.id).where(
         and_(
-            UserEvent.user_id == user.id,
-            UserEvent.action == 'nudge',
-            func.date(UserEvent.created_at.astimezone(tz)) == today
+            UserEvent.user_id == bindparam('u'),
+            UserEvent.action == bindparam('action'),
+            UserEvent.created_at >= bindparam('start'),
+            UserEvent.created_at < bindparam('end')
         )
-    ).first()
+    ).limit(1))
+    event_id = await db.scalar(
+        stmt, {'u': user.id, 'action': action, 'start': start_utc, 'end': end_utc}
+    )
     
-    return nudge_today is not None
+    return event_id is not None
 
 
-def did_read_today(db: Session, user: User) -> bool:
+async def was_nudged_today(db: AsyncSession, user: User, now: Optional[datetime] = None) -> bool:
+    """Check if user was nudged today"""
+    return await _has_event_today(db, user, 'nudge', now)
+
+
+async def did_read_today(db: AsyncSession, user: User, now: Optional[datetime] = None) -> bool:
     """Check if user read today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
-    
-    read_today = db.query(UserEvent).filter(
-        and_(
-            UserEvent.user_id == user.id,
-            UserEvent.action == 'read',
-            func.date(UserEvent.created_at.astimezone(tz)) == today
-        )
-    ).first()
+    return await _has_event_today(db, user, 'read', now)
+
+
+async def claim_daily_card_sends(db: AsyncSession, user_ids: List[int], today: date) -> set:
+    """Atomically mark users not yet sent today's card, returns the ids this call claimed (caller commits)"""
+    if not user_ids:
+        return set()
     
-    return read_today is not None
+    # The date condition makes overlapping cron runs claim each user only once
+    result = await db.execute(
+        update(User).where(
+            User.id.in_(user_ids),
+            or_(User.last_daily_sent.is_(None), User.last_daily_sent < today)
+        ).values(last_daily_sent=today).returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(result.scalars())
 
 
-def was_daily_card_sent_today(db: Session, user: User) -> bool:
-    """Check if daily card was sent today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
+async def claim_nudge_sends(db: AsyncSession, user_ids: List[int], today: date) -> set:
+    """Atomically mark users not yet nudged today, returns the ids this call claimed (caller commits)"""
+    if not user_ids:
+        return set()
     
-    return user.last_daily_sent == today
+    # The date condition makes overlapping cron runs claim each user only once
+    result = await db.execute(
+        update(User).where(
+            User.id.in_(user_ids),
+            or_(User.last_nudge_sent.is_(None), User.last_nudge_sent < today)
+        ).values(last_nudge_sent=today).returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    return set(result.scalars())
 
 
-def mark_daily_card_sent_today(db: Session, user: User) -> None:
-    """Mark that daily card was sent today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
+async def set_daily_card_sent(db: AsyncSession, user_ids: List[int],
+                              sent_on: Optional[date]) -> None:
+    """Set last_daily_sent for many users in one UPDATE (caller commits)"""
+    if not user_ids:
+        return
     
-    user.last_daily_sent = today
-    db.commit()
+    await db.execute(
+        update(User).where(User.id.in_(user_ids)).values(last_daily_sent=sent_on)
+        .execution_options(synchronize_session=False)
+    )
 
 
-def mark_nudge_sent_today(db: Session, user: User) -> None:
-    """Mark that nudge was sent today"""
-    tz = get_user_timezone(user)
-    today = datetime.now(tz).date()
+async def set_nudge_sent(db: AsyncSession, user_ids: List[int],
+                         sent_on: Optional[date]) -> None:
+    """Set last_nudge_sent for many users in one UPDATE (caller commits)"""
+    if not user_ids:
+        return
     
-    user.last_nudge_sent = today
-    db.commit()
+    await db.execute(
+        update(User).where(User.id.in_(user_ids)).values(last_nudge_sent=sent_on)
+        .execution_options(synchronize_session=False)
+    )
 
 
-def get_user_stats(db: Session, user: User) -> Dict[str, Any]:
+async def get_user_stats(db: AsyncSession, user: User, now: Optional[datetime] = None) -> Dict[str, Any]:
     """Get comprehensive user statistics"""
-    current_month, current_day = get_current_pointer(db, user)
-    next_month, next_day = get_next_pointer(current_month, current_day)
-    streak = get_reading_streak(db, user)
-    breaks_used = get_breaks_used(db, user)
-    breaks_left = get_breaks_left(db, user)
+    now = get_user_local_now(user.timezone, now)
+    thirty_days_ago = now - timedelta(days=30)
     
-    # Count total completed readings
-    total_completed = db.query(UserProgress).filter(
-        UserProgress.user_id == user.id
-    ).count()
+    # Fetch break count and completed count in a single round-trip
+    result = await db.execute(_USER_COUNTS_SQL, {'u': user.id, 'cutoff': thirty_days_ago})
+    breaks_30d, total_completed = result.one()
+    
+    streak = await get_reading_streak(db, user, now)
+    return _build_stats(user, streak, breaks_30d, total_completed)
+
+
+def _build_stats(user: User, streak: int, breaks_30d: int, total_completed: int) -> Dict[str, Any]:
+    """Assemble the stats dict from the raw per-user numbers"""
+    # The stored pointer is the pending reading, which is also the next one to read
+    current_month, current_day = get_current_pointer(user)
+    next_month, next_day = current_month, current_day
+    
+    breaks_used = min(breaks_30d, settings.max_breaks_per_30_days)
+    breaks_left = max(0, settings.max_breaks_per_30_days - breaks_used)
     
     return {
         'streak': streak,
@@ -284,75 +445,200 @@ def get_user_stats(db: Session, user: User) -> Dict[str, Any]:
     }
 
 
-def is_time_for_daily_card(user: User) -> bool:
+async def _get_read_dates_by_user(db: AsyncSession, users: List[User],
+                                  since: datetime) -> Dict[int, set]:
+    """Get distinct local read dates since the given time for many users at once"""
+    user_ids = [user.id for user in users]
+    read_dates: Dict[int, set] = {user_id: set() for user_id in user_ids}
+    
+    if db.bind.dialect.name == 'postgresql':
+        # Convert to each user's local date in SQL
+        local_date = func.date(UserEvent.created_at.op('AT TIME ZONE')(User.timezone))
+        result = await db.execute(
+            select(UserEvent.user_id, local_date).distinct()
+            .join(User, User.id == UserEvent.user_id)
+            .where(
+                UserEvent.user_id.in_(user_ids),
+                UserEvent.action == 'read',
+                UserEvent.created_at >= since
+            )
+        )
+        for user_id, read_date in result:
+            read_dates[user_id].add(read_date)
+        return read_dates
+    
+    tz_by_user = {user.id: get_user_timezone(user.timezone) for user in users}
+    result = await db.execute(
+        select(UserEvent.user_id, UserEvent.created_at).where(
+            UserEvent.user_id.in_(user_ids),
+            UserEvent.action == 'read',
+            UserEvent.created_at >= since
+        )
+    )
+    for user_id, created_at in result:
+        read_dates[user_id].add(created_at.astimezone(tz_by_user[user_id]).date())
+    return read_dates
+
+
+async def get_users_stats(db: AsyncSession, users: List[User],
+                          now: datetime) -> Dict[int, Dict[str, Any]]:
+    """Get stats for many users with a fixed number of queries, keyed by user id"""
+    if not users:
+        return {}
+    
+    user_ids = [user.id for user in users]
+    thirty_days_ago = now - timedelta(days=30)
+    
+    result = await db.execute(
+        select(UserEvent.user_id, func.count(UserEvent.id)).where(
+            UserEvent.user_id.in_(user_ids),
+            UserEvent.action == 'break',
+            UserEvent.created_at >= thirty_days_ago
+        ).group_by(UserEvent.user_id)
+    )
+    breaks_by_user = dict(result.all())
+    
+    result = await db.execute(
+        select(UserProgress.user_id, func.count(UserProgress.id)).where(
+            UserProgress.user_id.in_(user_ids)
+        ).group_by(UserProgress.user_id)
+    )
+    completed_by_user = dict(result.all())
+    
+    read_dates_by_user = await _get_read_dates_by_user(
+        db, users, now - timedelta(days=STREAK_WINDOW_DAYS)
+    )
+    
+    stats_by_user = {}
+    for user in users:
+        today = get_user_local_date(user.timezone, now)
+        streak = _count_streak(read_dates_by_user[user.id], today)
+        if streak >= STREAK_WINDOW_DAYS:
+            # Rare long streak, let the single-user version widen the window
+            streak = await get_reading_streak(db, user, now)
+        
+        stats_by_user[user.id] = _build_stats(
+            user, streak, breaks_by_user.get(user.id, 0), completed_by_user.get(user.id, 0)
+        )
+    return stats_by_user
+
+
+async def get_read_today_user_ids(db: AsyncSession, user_ids: List[int],
+                                  now: datetime) -> set:
+    """Get which of the given users (all sharing `now`'s timezone) read today"""
+    if not user_ids:
+        return set()
+    
+    start_utc, end_utc = _get_local_day_bounds(now)
+    result = await db.execute(
+        select(distinct(UserEvent.user_id)).where(
+            UserEvent.user_id.in_(user_ids),
+            UserEvent.action == 'read',
+            UserEvent.created_at >= start_utc,
+            UserEvent.created_at < end_utc
+        )
+    )
+    return set(result.scalars())
+
+
+def _minutes_from_target(now: datetime, target_minutes: int) -> int:
+    """Distance in minutes between `now`'s time of day and a target minute of the day"""
+    return abs((now.hour * 60 + now.minute) - target_minutes)
+
+
+def is_time_for_daily_card(tz_name: str, now: Optional[datetime] = None) -> bool:
     """Check if it's time to send daily card (around 07:00 local time)"""
-    tz = get_user_timezone(user)
-    now = datetime.now(tz)
-    current_time = now.time()
+    now = get_user_local_now(tz_name, now)
     
     # Check if it's around 07:00 (within 1 hour window)
-    target_time = datetime.strptime("07:00", "%H:%M").time()
-    time_diff = abs((current_time.hour * 60 + current_time.minute) - 
-                   (target_time.hour * 60 + target_time.minute))
-    
-    return time_diff <= 60  # Within 1 hour
+    return _minutes_from_target(now, DAILY_CARD_MINUTES) <= 60
 
 
-def is_time_for_nudge(user: User) -> bool:
+def is_time_for_nudge(tz_name: str, now: Optional[datetime] = None) -> bool:
     """Check if it's time to send nudge (around 20:00 local time)"""
-    tz = get_user_timezone(user)
-    now = datetime.now(tz)
-    current_time = now.time()
+    now = get_user_local_now(tz_name, now)
     
     # Check if it's around 20:00 (within 1 hour window)
-    target_time = datetime.strptime("20:00", "%H:%M").time()
-    time_diff = abs((current_time.hour * 60 + current_time.minute) - 
-                   (target_time.hour * 60 + target_time.minute))
+    return _minutes_from_target(now, NUDGE_MINUTES) <= 60
+
+
+async def load_user_ctx(db: AsyncSession, telegram_id: int) -> Optional[UserCtx]:
+    """Load only the user columns read-only paths need, without ORM hydration"""
+    result = await db.execute(
+        select(User.id, User.timezone, User.current_month, User.current_day).where(
+            User.telegram_id == telegram_id
+        )
+    )
+    row = result.first()
+    return UserCtx(*row) if row else None
+
+
+async def get_user_by_telegram_id(db: AsyncSession, telegram_id: int) -> Optional[User]:
+    """Get user by telegram_id"""
+    result = await db.execute(select(User).where(User.telegram_id == telegram_id))
+    return result.scalars().first()
+
+
+def _insert(db: AsyncSession, table):
+    """Get a dialect-specific INSERT that supports ON CONFLICT"""
+    if db.bind.dialect.name == 'sqlite':
+        return sqlite_insert(table)
+    return pg_insert(table)
+
+
+async def claim_callback(db: AsyncSession, callback_id: str) -> bool:
+    """Record callback as processed in the current transaction, False if already recorded
     
-    return time_diff <= 60  # Within 1 hour
+    Not committed here, so the claim lands in the same commit as the work it guards.
+    """
+    stmt = _insert(db, ProcessedCallback).values(callback_id=callback_id)
+    stmt = stmt.on_conflict_do_nothing(index_elements=['callback_id'])
+    result = await db.execute(stmt)
+    return result.rowcount == 1
 
 
-def upsert_user(db: Session, telegram_id: int, username: str = None, 
+async def upsert_user(db: AsyncSession, telegram_id: int, username: str = None, 
                 first_name: str = None, last_name: str = None) -> User:
-    """Upsert user by telegram_id"""
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    
-    if not user:
-        # Create new user
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name,
-            timezone=settings.default_tz,
-            current_month=settings.start_at_month,
-            current_day=settings.start_at_day
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    else:
-        # Update existing user info
-        user.username = username
-        user.first_name = first_name
-        user.last_name = last_name
-        db.commit()
-    
-    return user
-
-
-def ensure_user_progress(db: Session, user: User) -> None:
-    """Ensure user has a progress record starting at Month=1, Day=1 if missing"""
-    existing_progress = db.query(UserProgress).filter(
-        UserProgress.user_id == user.id
-    ).first()
-    
-    if not existing_progress:
-        # Create initial progress record
-        progress = UserProgress(
-            user_id=user.id,
-            month=settings.start_at_month,
-            day=settings.start_at_day
-        )
-        db.add(progress)
-        db.commit()
\ No newline at end of file
+    """Upsert user by telegram_id (caller commits)"""
+    user = await get_user_by_telegram_id(db, telegram_id)
+    
+    if user:
+        # Returning user: only touch columns that actually changed, so an
+        # unchanged /start doesn't write anything
+        for attr, value in (('username', username), ('first_name', first_name),
+                            ('last_name', last_name)):
+            if getattr(user, attr) != value:
+                setattr(user, attr, value)
+        if user.current_month is None or user.current_day is None:
+            # Initialise the pointer kept on the user row
+            user.current_month = user.current_month or settings.start_at_month
+            user.current_day = user.current_day or settings.start_at_day
+        if db.is_modified(user):
+            await db.flush()
+        return user
+    
+    # New user; ON CONFLICT covers a concurrent /start creating it first
+    stmt = _insert(db, User).values(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+        timezone=settings.default_tz,
+        current_month=settings.start_at_month,
+        current_day=settings.start_at_day
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['telegram_id'],
+        set_={
+            'username': stmt.excluded.username,
+            'first_name': stmt.excluded.first_name,
+            'last_name': stmt.excluded.last_name,
+            # Initialise the pointer kept on the user row if it is missing
+            'current_month': func.coalesce(User.current_month, stmt.excluded.current_month),
+            'current_day': func.coalesce(User.current_day, stmt.excluded.current_day),
+            'updated_at': func.now()
+        }
+    ).returning(User)
+    
+    result = await db.execute(stmt, execution_options={'populate_existing': True})
+    return result.scalar_one()
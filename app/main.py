@@ -1,29 +1,52 @@
 from fastapi import FastAPI, Request, Depends
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 import asyncio
 import logging
+import logging.handlers
+import queue
 
+from app.bot_instance import get_bot
 from app.config import settings
-from app.db import get_db, engine, Base
+from app.db import get_db, get_engine, Base, new_session
 from app.handlers import register_handlers
+from app.logic import load_plan_cache
 from app.scheduler import router as scheduler_router
 
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route log records through a queue so handler I/O happens off the event loop"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Create FastAPI app
 app = FastAPI(title="Bible Reading Tracker Bot", version="1.0.0")
 
-# Create bot and dispatcher
-bot = Bot(token=settings.telegram_token)
+# Create dispatcher for the shared bot
 dp = Dispatcher()
 
 # Register handlers
 register_handlers(dp)
 
+# Updates being processed in the background, kept so shutdown can wait for them
+_update_tasks: set[asyncio.Task] = set()
+
 # Include scheduler routes
 app.include_router(scheduler_router, prefix="/api")
 
@@ -32,19 +55,42 @@ app.include_router(scheduler_router, prefix="/api")
 async def on_startup():
     """Initialize database and set webhook on startup"""
     # Create tables
-    Base.metadata.create_all(bind=engine)
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    
+    # Load reading plan into memory
+    async with new_session() as db:
+        plan_count = await load_plan_cache(db)
+        logger.info(f"Loaded {plan_count} readings into plan cache")
     
     # Set webhook
     webhook_url = f"{settings.webhook_base_url}/webhook"
-    await bot.set_webhook(webhook_url)
+    await get_bot().set_webhook(webhook_url)
     logger.info(f"Webhook set to: {webhook_url}")
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     """Cleanup on shutdown"""
+    # Let in-flight updates finish before closing the bot session and engine
+    if _update_tasks:
+        await asyncio.gather(*_update_tasks, return_exceptions=True)
+    
+    bot = get_bot()
     await bot.delete_webhook()
     await bot.session.close()
+    await get_engine().dispose()
+    
+    # Flush any queued log records
+    log_listener.stop()
+
+
+async def process_update(update: types.Update):
+    """Process a single update, logging any failure"""
+    try:
+        await dp.feed_update(get_bot(), update)
+    except Exception:
+        logger.exception(f"Update {update.update_id} processing error")
 
 
 @app.post("/webhook")
@@ -53,10 +99,12 @@ async def webhook_handler(request: Request):
     try:
         # Get update from request
         update_data = await request.json()
-        update = types.Update(**update_data)
+        update = types.Update.model_validate(update_data, context={"bot": get_bot()})
         
-        # Process update
-        await dp.process_update(update)
+        # Process update in the background so Telegram gets its ACK immediately
+        task = asyncio.create_task(process_update(update))
+        _update_tasks.add(task)
+        task.add_done_callback(_update_tasks.discard)
         
         return {"ok": True}
         
@@ -1,17 +1,17 @@
 import re
-from typing import Dict, Any
+from functools import lru_cache
+from typing import Dict, Any, Optional
 
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-def escape_markdown_v2(text: str) -> str:
-    """Escape text for MarkdownV2"""
-    # Characters that need escaping in MarkdownV2
-    escape_chars = r'[_*[\]()~`>#+=|{}.!-]'
-    return re.sub(escape_chars, r'\\\1', text)
 
+# Characters that need escaping in MarkdownV2
+_MD2_RE = re.compile(r'([_*\[\]()~`>#+=|{}.!\-])')
 
-def get_daily_card_template() -> str:
-    """Template for daily reading card (MarkdownV2)"""
-    return """📖 *Day {day} — Month {month}*
+# Reading button actions by the first character of their packed callback_data
+_CALLBACK_ACTIONS = {'r': "read", 'b': "break"}
+
+_DAILY_TEMPLATE = """📖 *Day {day} — Month {month}*
 
 🔥 Current streak: {streak} day{plural}
 🛌 Breaks left \\(last 30 days\\): {breaks_left}/5
@@ -25,6 +25,16 @@ def get_daily_card_template() -> str:
 \\- {ot2}"""
 
 
+def escape_markdown_v2(text: str) -> str:
+    """Escape text for MarkdownV2"""
+    return _MD2_RE.sub(r'\\\1', text)
+
+
+def get_daily_card_template() -> str:
+    """Template for daily reading card (MarkdownV2)"""
+    return _DAILY_TEMPLATE
+
+
 def get_help_message() -> str:
     """Help message with commands and break rules (MarkdownV2)"""
     return """🤖 *Bible Reading Tracker Bot*
@@ -111,4 +121,44 @@ def format_reading_text(reading: Dict[str, Any], stats: Dict[str, Any]) -> str:
         nt2=nt2,
         ot1=ot1,
         ot2=ot2
-    )
\ No newline at end of file
+    )
+
+
+def pack_reading_callback(action: str, month: int, day: int) -> str:
+    """Pack a reading button's action and (month, day) into a short callback_data, e.g. 'r03f'"""
+    return f"{action[0]}{month * 32 + day:03x}"
+
+
+def unpack_callback_data(data: Optional[str]) -> tuple[Optional[str], Optional[tuple[int, int]]]:
+    """Unpack callback_data into (action, (month, day) or None); (None, None) if not recognised"""
+    if not data:
+        return None, None
+    if data == "next":
+        return "next", None
+    
+    try:
+        # Buttons on cards sent before packing was introduced still carry 'read|m|d'
+        if '|' in data:
+            action, month, day = data.split('|')
+            if action not in _CALLBACK_ACTIONS.values():
+                return None, None
+            return action, (int(month), int(day))
+        
+        action = _CALLBACK_ACTIONS.get(data[:1])
+        if action is None:
+            return None, None
+        return action, divmod(int(data[1:], 16), 32)
+    except ValueError:
+        return None, None
+
+
+@lru_cache(maxsize=512)
+def get_reading_keyboard(month: int, day: int) -> InlineKeyboardMarkup:
+    """Inline keyboard for a reading card (cached and shared, must not be mutated)"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Read", callback_data=pack_reading_callback("read", month, day)),
+            InlineKeyboardButton(text="🛌 Break", callback_data=pack_reading_callback("break", month, day))
+        ],
+        [InlineKeyboardButton(text="📖 Next", callback_data="next")]
+    ])
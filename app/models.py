@@ -1,5 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Date, Index
 from sqlalchemy.sql import func
 from app.db import Base
 
@@ -20,9 +19,11 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
-    # Relationships
-    progress = relationship("UserProgress", back_populates="user")
-    events = relationship("UserEvent", back_populates="user")
+    # Serve the cron lookups of users in a timezone not yet sent today's card/nudge
+    __table_args__ = (
+        Index("idx_users_timezone_last_daily_sent", "timezone", "last_daily_sent"),
+        Index("idx_users_timezone_last_nudge_sent", "timezone", "last_nudge_sent"),
+    )
 
 
 class Plan(Base):
@@ -55,8 +56,10 @@ class UserProgress(Base):
     day = Column(Integer, nullable=False)
     completed_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    # Relationships
-    user = relationship("User", back_populates="progress")
+    # Serves the per-user progress counts
+    __table_args__ = (
+        Index("idx_user_progress_user_id", "user_id"),
+    )
 
 
 class UserEvent(Base):
@@ -69,8 +72,10 @@ class UserEvent(Base):
     plan_day = Column(Integer, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
-    # Relationships
-    user = relationship("User", back_populates="events")
+    # Serves the per-user "event of this action within a time range" lookups
+    __table_args__ = (
+        Index("idx_user_events_user_type_created_at", "user_id", "action", "created_at"),
+    )
 
 
 class ProcessedCallback(Base):
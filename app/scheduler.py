@@ -1,144 +1,277 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
 from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
-from datetime import datetime, time
-from zoneinfo import ZoneInfo
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import distinct, or_, select
+from datetime import datetime, timezone
+from typing import Dict, Any
 
+from app.bot_instance import get_bot
 from app.db import get_db
-from app.models import User, UserEvent
+from app.models import User
 from app.config import settings
 from app.logic import (
-    get_next_reading, get_user_stats,
-    did_read_today, was_nudged_today, record_nudge,
-    get_user_timezone, get_user_local_now, is_time_for_daily_card,
-    is_time_for_nudge, was_daily_card_sent_today, mark_daily_card_sent_today,
-    mark_nudge_sent_today
+    get_users_stats, get_read_today_user_ids, record_nudges, get_user_local_now,
+    is_time_for_daily_card, is_time_for_nudge, set_daily_card_sent, set_nudge_sent,
+    claim_daily_card_sends, claim_nudge_sends, get_current_pointer, get_plan,
+    get_reading_by_pointer
 )
-from app.messages import get_nudge_message, format_reading_text
+from app.messages import get_nudge_message, format_reading_text, get_reading_keyboard
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# Max concurrent Telegram sends during cron fan-out
+SEND_CONCURRENCY = 20
+
+# Max Telegram sends started per second; bots are limited to about 30 messages/s
+SEND_RATE_PER_SECOND = 25
+
+# How many times a send is retried when Telegram asks us to slow down
+MAX_SEND_RETRIES = 3
+
 
 def verify_cron_secret(x_cron_secret: str = Header(None)):
     """Verify cron secret for security"""
-    if not x_cron_secret or x_cron_secret != settings.cron_secret:
+    # Constant-time comparison; bytes so non-ASCII input can't raise
+    if not x_cron_secret or not hmac.compare_digest(
+        x_cron_secret.encode(), settings.cron_secret.encode()
+    ):
         raise HTTPException(status_code=401, detail="Unauthorized")
     return True
 
 
-async def send_daily_card_to_user(user: User, db: Session, bot):
-    """Send daily card to a specific user"""
+async def send_with_retry(send, **kwargs):
+    """Call a Telegram send method, waiting and retrying when rate limited"""
+    for _ in range(MAX_SEND_RETRIES):
+        try:
+            return await send(**kwargs)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram rate limit hit, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+    return await send(**kwargs)
+
+
+async def send_daily_card_to_user(user: User, bot, text: str,
+                                  keyboard: InlineKeyboardMarkup) -> bool:
+    """Send a pre-formatted daily card to a specific user (I/O only, safe to run concurrently)"""
     try:
-        # Get current pointer and reading
-        from app.logic import get_current_pointer, get_reading_by_pointer
-        current_month, current_day = get_current_pointer(db, user)
-        reading = get_reading_by_pointer(db, current_month, current_day)
-        
-        if not reading:
-            return False
-        
-        # Get stats and format message
-        stats = get_user_stats(db, user)
-        text = format_reading_text(reading, stats)
-        
-        # Create keyboard
-        from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton("✅ Read", callback_data=f"read|{reading['month']}|{reading['day']}"),
-                InlineKeyboardButton("🛌 Break", callback_data=f"break|{reading['month']}|{reading['day']}")
-            ],
-            [InlineKeyboardButton("📖 Next", callback_data="next")]
-        ])
-        
-        # Send message
-        await bot.send_message(
+        await send_with_retry(
+            bot.send_message,
             chat_id=user.telegram_id,
             text=text,
             parse_mode='MarkdownV2',
             reply_markup=keyboard
         )
-        
-        # Mark as sent today
-        mark_daily_card_sent_today(db, user)
         return True
         
-    except Exception as e:
-        print(f"Error sending daily card to user {user.telegram_id}: {e}")
+    except Exception:
+        logger.exception(f"Error sending daily card to user {user.telegram_id}")
         return False
 
 
-async def send_nudge_to_user(user: User, db: Session, bot):
-    """Send nudge to a specific user"""
+async def send_nudge_to_user(user: User, bot) -> bool:
+    """Send nudge to a specific user (no database access, safe to run concurrently)"""
     try:
-        await bot.send_message(
+        await send_with_retry(
+            bot.send_message,
             chat_id=user.telegram_id,
             text=get_nudge_message(),
             parse_mode='MarkdownV2'
         )
-        
-        # Record nudge and mark as sent today
-        record_nudge(db, user)
-        mark_nudge_sent_today(db, user)
         return True
         
-    except Exception as e:
-        print(f"Error sending nudge to user {user.telegram_id}: {e}")
+    except Exception:
+        logger.exception(f"Error sending nudge to user {user.telegram_id}")
         return False
 
 
+async def gather_with_limit(coros, limit: int = SEND_CONCURRENCY,
+                            rate: float = SEND_RATE_PER_SECOND) -> list:
+    """Run coroutines concurrently, at most `limit` at a time and `rate` starts per second; exceptions are returned"""
+    sem = asyncio.Semaphore(limit)
+    loop = asyncio.get_running_loop()
+    interval = 1 / rate
+    next_start = loop.time()
+    
+    async def _run_with_sem(coro):
+        nonlocal next_start
+        async with sem:
+            # Take the next free start slot and wait for it
+            start = max(next_start, loop.time())
+            next_start = start + interval
+            await asyncio.sleep(start - loop.time())
+            return await coro
+    
+    return await asyncio.gather(*(_run_with_sem(coro) for coro in coros), return_exceptions=True)
+
+
+async def revert_sent_markers(db: AsyncSession, set_sent, previous_sent: dict,
+                              failed_ids: list[int]) -> None:
+    """Restore the previous sent date for users whose send failed, one UPDATE per distinct date"""
+    ids_by_previous: Dict[Any, list[int]] = {}
+    for user_id in failed_ids:
+        ids_by_previous.setdefault(previous_sent[user_id], []).append(user_id)
+    for previous, user_ids in ids_by_previous.items():
+        await set_sent(db, user_ids, previous)
+
+
+async def get_due_timezones(db: AsyncSession, is_due) -> list[tuple[str, datetime]]:
+    """Get (timezone, local now) for every user timezone where `is_due` holds right now"""
+    result = await db.execute(select(distinct(User.timezone)).where(User.timezone.isnot(None)))
+    
+    # One clock read for the whole tick, converted per timezone
+    utc_now = datetime.now(timezone.utc)
+    
+    due = []
+    for tz_name in result.scalars():
+        try:
+            now = get_user_local_now(tz_name, utc_now)
+        except Exception as e:
+            logger.warning(f"Skipping invalid timezone {tz_name}: {e}")
+            continue
+        if is_due(tz_name, now):
+            due.append((tz_name, now))
+    return due
+
+
 @router.post("/cron/daily")
 async def daily_cron(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_cron_secret)
 ):
     """Daily cron job - send reading cards at 07:00 local time"""
-    from app.main import bot
-    
-    # Get all users
-    users = db.query(User).all()
+    bot = get_bot()
     sent_count = 0
     
-    for user in users:
-        try:
-            # Check if it's time for daily card and not already sent today
-            if is_time_for_daily_card(user) and not was_daily_card_sent_today(db, user):
-                success = await send_daily_card_to_user(user, db, bot)
-                if success:
-                    sent_count += 1
-                        
-        except Exception as e:
-            print(f"Error processing user {user.telegram_id} for daily cron: {e}")
-            continue
+    # Whole plan in memory (loaded once), instead of a lookup per user
+    plans = await get_plan(db)
+    
+    # Only timezones where it's currently around 07:00 need looking at
+    for tz_name, now in await get_due_timezones(db, is_time_for_daily_card):
+        today = now.date()
+        
+        # Users in this timezone that haven't had today's card yet; plain rows
+        # with just the columns needed, no ORM objects
+        result = await db.execute(
+            select(
+                User.id, User.telegram_id, User.timezone, User.current_month,
+                User.current_day, User.last_daily_sent
+            ).where(
+                User.timezone == tz_name,
+                or_(User.last_daily_sent.is_(None), User.last_daily_sent < today)
+            )
+        )
+        users = result.all()
+        
+        # Fetch stats for the whole batch instead of per user
+        stats_by_user = await get_users_stats(db, users, now)
+        
+        # Look up readings and format the cards up front, so the concurrent
+        # sends below only do I/O and never touch the session
+        cards = []
+        for user in users:
+            pointer = get_current_pointer(user)
+            reading = plans.get(pointer)
+            if reading is None:
+                # Not in the in-memory plan, check the database before giving up
+                reading = await get_reading_by_pointer(db, *pointer)
+            if reading is None:
+                logger.warning(f"No reading for {pointer} of user {user.telegram_id}, daily card skipped")
+                continue
+            
+            text = format_reading_text(reading, stats_by_user[user.id])
+            keyboard = get_reading_keyboard(reading['month'], reading['day'])
+            cards.append((user, text, keyboard))
+        
+        # Claim the whole batch in one UPDATE before sending, committing so no
+        # pooled connection is held while waiting on Telegram. Only users still
+        # unsent are claimed, so an overlapping run can't send them twice;
+        # failed sends are rolled back below
+        previous_sent = {user.id: user.last_daily_sent for user, _, _ in cards}
+        claimed_ids = await claim_daily_card_sends(db, list(previous_sent), today)
+        await db.commit()
+        cards = [card for card in cards if card[0].id in claimed_ids]
+        
+        results = await gather_with_limit(
+            send_daily_card_to_user(user, bot, text, keyboard)
+            for user, text, keyboard in cards
+        )
+        
+        # Count successful sends and undo the mark for failed ones
+        failed_ids = []
+        for (user, _, _), result in zip(cards, results):
+            if result is True:
+                sent_count += 1
+                continue
+            if isinstance(result, Exception):
+                logger.error(f"Error processing user {user.telegram_id} for daily cron", exc_info=result)
+            failed_ids.append(user.id)
+        await revert_sent_markers(db, set_daily_card_sent, previous_sent, failed_ids)
+        await db.commit()
     
     return {"message": f"Daily cron completed. Sent {sent_count} cards."}
 
 
 @router.post("/cron/nudge")
 async def nudge_cron(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     _: bool = Depends(verify_cron_secret)
 ):
     """Nudge cron job - send nudges at 20:00 local time"""
-    from app.main import bot
-    
-    # Get all users
-    users = db.query(User).all()
+    bot = get_bot()
     nudged_count = 0
     
-    for user in users:
-        try:
-            # Check if it's time for nudge, user hasn't read today, and not already nudged today
-            if (is_time_for_nudge(user) and 
-                not did_read_today(db, user) and 
-                not was_nudged_today(db, user)):
-                success = await send_nudge_to_user(user, db, bot)
-                if success:
-                    nudged_count += 1
-                        
-        except Exception as e:
-            print(f"Error processing user {user.telegram_id} for nudge cron: {e}")
-            continue
+    # Only timezones where it's currently around 20:00 need looking at
+    for tz_name, now in await get_due_timezones(db, is_time_for_nudge):
+        today = now.date()
+        
+        # Users in this timezone that haven't been nudged today; plain rows
+        # with just the columns needed, no ORM objects
+        result = await db.execute(
+            select(User.id, User.telegram_id, User.last_nudge_sent).where(
+                User.timezone == tz_name,
+                or_(User.last_nudge_sent.is_(None), User.last_nudge_sent < today)
+            )
+        )
+        users = result.all()
+        
+        # Find who already read today for the whole batch instead of per user
+        read_today_ids = await get_read_today_user_ids(db, [user.id for user in users], now)
+        
+        # Only nudge users who haven't read today
+        to_nudge = [user for user in users if user.id not in read_today_ids]
+        
+        # Claim the whole batch in one UPDATE before sending, committing so no
+        # pooled connection is held while waiting on Telegram. Only users still
+        # un-nudged are claimed, so an overlapping run can't nudge them twice;
+        # failed sends are rolled back below
+        previous_sent = {user.id: user.last_nudge_sent for user in to_nudge}
+        claimed_ids = await claim_nudge_sends(db, list(previous_sent), today)
+        await db.commit()
+        to_nudge = [user for user in to_nudge if user.id in claimed_ids]
+        
+        results = await gather_with_limit(send_nudge_to_user(user, bot) for user in to_nudge)
+        
+        # Record successful nudges and undo the mark for failed ones
+        nudged_ids = []
+        failed_ids = []
+        for user, result in zip(to_nudge, results):
+            if result is True:
+                nudged_ids.append(user.id)
+                continue
+            if isinstance(result, Exception):
+                logger.error(f"Error processing user {user.telegram_id} for nudge cron", exc_info=result)
+            failed_ids.append(user.id)
+        await record_nudges(db, nudged_ids)
+        await revert_sent_markers(db, set_nudge_sent, previous_sent, failed_ids)
+        await db.commit()
+        nudged_count += len(nudged_ids)
     
     return {"message": f"Nudge cron completed. Sent {nudged_count} nudges."}
 
@@ -11,6 +11,8 @@ CREATE TABLE IF NOT EXISTS users (
     timezone VARCHAR(50) DEFAULT 'Asia/Singapore',
     current_month INTEGER DEFAULT 1,
     current_day INTEGER DEFAULT 1,
+    last_daily_sent DATE,
+    last_nudge_sent DATE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
@@ -66,3 +68,8 @@ CREATE INDEX IF NOT EXISTS idx_user_events_user_id ON user_events(user_id);
 CREATE INDEX IF NOT EXISTS idx_user_events_event_type ON user_events(event_type);
 CREATE INDEX IF NOT EXISTS idx_user_events_created_at ON user_events(created_at);
 CREATE INDEX IF NOT EXISTS idx_processed_callbacks_callback_id ON processed_callbacks(callback_id);
+
+-- Composite indexes for the per-user hot queries
+CREATE INDEX IF NOT EXISTS idx_user_events_user_type_created_at ON user_events(user_id, event_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_users_timezone_last_daily_sent ON users(timezone, last_daily_sent);
+CREATE INDEX IF NOT EXISTS idx_users_timezone_last_nudge_sent ON users(timezone, last_nudge_sent);
@@ -11,13 +11,48 @@ from sqlalchemy import create_engine
 from sqlalchemy.dialects.postgresql import insert
 
 from app.config import settings
+from app.db import get_engine_options
 from app.models import Plan, Base
 
+# Rows per INSERT batch, and how many batches between commits
+BATCH_SIZE = 500
+COMMIT_EVERY_BATCHES = 10
+
+
+def iter_plan_batches(reader, batch_size: int = BATCH_SIZE):
+    """Yield lists of plan rows from a CSV reader, batch_size rows at a time"""
+    batch = []
+    for row in reader:
+        batch.append({
+            'month': int(row['Month']),
+            'day': int(row['Day']),
+            'nt1_book': row['NT1_Book'],
+            'nt1_chapter': row['NT1_Chapter'],
+            'nt2_book': row['NT2_Book'],
+            'nt2_chapter': row['NT2_Chapter'],
+            'ot1_book': row['OT1_Book'],
+            'ot1_chapter': row['OT1_Chapter'],
+            'ot2_book': row['OT2_Book'],
+            'ot2_chapter': row['OT2_Chapter']
+        })
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    
+    if batch:
+        yield batch
+
+
 def seed_plan_from_csv(csv_file_path: str):
     """Seed plan table from CSV file with upsert functionality"""
     
-    # Create database connection
-    engine = create_engine(settings.database_url)
+    # Create database connection; executemany inserts are sent as one multi-row
+    # VALUES statement per batch
+    engine = create_engine(
+        settings.database_url,
+        insertmanyvalues_page_size=BATCH_SIZE,
+        **get_engine_options(settings.database_url)
+    )
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
     
     # Create tables
@@ -26,27 +61,9 @@ def seed_plan_from_csv(csv_file_path: str):
     db = SessionLocal()
     
     try:
-        # Read CSV and prepare data for upsert
-        plan_data = []
-        with open(csv_file_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            
-            for row in reader:
-                plan_data.append({
-                    'month': int(row['Month']),
-                    'day': int(row['Day']),
-                    'nt1_book': row['NT1_Book'],
-                    'nt1_chapter': row['NT1_Chapter'],
-                    'nt2_book': row['NT2_Book'],
-                    'nt2_chapter': row['NT2_Chapter'],
-                    'ot1_book': row['OT1_Book'],
-                    'ot1_chapter': row['OT1_Chapter'],
-                    'ot2_book': row['OT2_Book'],
-                    'ot2_chapter': row['OT2_Chapter']
-                })
-        
-        # Upsert data using PostgreSQL's ON CONFLICT
-        stmt = insert(Plan).values(plan_data)
+        # Upsert using PostgreSQL's ON CONFLICT; the statement is built once and
+        # executed per batch with that batch's rows as parameters
+        stmt = insert(Plan)
         stmt = stmt.on_conflict_do_update(
             index_elements=['month', 'day'],
             set_={
@@ -61,9 +78,19 @@ def seed_plan_from_csv(csv_file_path: str):
             }
         )
         
-        db.execute(stmt)
+        # Stream the CSV in batches instead of loading it all into memory
+        total = 0
+        with open(csv_file_path, 'r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            
+            for batch_number, batch in enumerate(iter_plan_batches(reader), start=1):
+                db.execute(stmt, batch)
+                total += len(batch)
+                if batch_number % COMMIT_EVERY_BATCHES == 0:
+                    db.commit()
+        
         db.commit()
-        print(f"Successfully seeded plan table with {len(plan_data)} entries from {csv_file_path}")
+        print(f"Successfully seeded plan table with {total} entries from {csv_file_path}")
         
     except Exception as e:
         print(f"Error seeding plan: {e}")